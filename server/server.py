@@ -1,28 +1,97 @@
 ### Imports ###
 import os
-from datetime import datetime, time
-from fastapi import FastAPI, HTTPException, Depends
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import date, datetime, time, timezone
+from functools import lru_cache
+from time import monotonic
+from fastapi import FastAPI, HTTPException, Body, Depends, Query
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 from sqlalchemy import (
-    create_engine,
     Column,
     Integer,
     String,
     Text,
     ForeignKey,
     DateTime,
-    func,
+    Index,
+    insert,
+    lambda_stmt,
+    delete,
+    event,
+    select,
+    text,
 )
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.schema import CreateIndex, CreateTable
 import uvicorn
 
 ### Define constants ###
-DATABASE_URL = "sqlite:////app/data/property_logs.db"
+DATABASE_URL = "sqlite+aiosqlite:////app/data/property_logs.db"
+TESTING = bool(os.getenv("TESTING"))
+# Keep the TESTING database in RAM where the platform offers a tmpfs
+TEST_DATABASE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+DB_POOL_SIZE = 20
+DB_MAX_OVERFLOW = 10
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BULK_EVENTS = 1000
+PROPERTY_CACHE_SIZE = 10000
+PROPERTY_CACHE_TTL = 60  # seconds
 
 ### Set up database ###
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if TESTING:
+    # Each process gets its own throwaway database, deleted on shutdown, so runs
+    # never see each other's data; with several workers, each has its own copy.
+    # A true :memory: database would put every session on one connection.
+    fd, test_database_path = tempfile.mkstemp(suffix=".db", dir=TEST_DATABASE_DIR)
+    os.close(fd)
+    database_url = "sqlite+aiosqlite:///" + test_database_path
+else:
+    database_url = DATABASE_URL
+
+engine = create_async_engine(
+    database_url,
+    connect_args={"check_same_thread": False},
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+)
+AsyncSessionMaker = async_sessionmaker(
+    engine, class_=AsyncSession, expire_on_commit=False
+)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    if TESTING:
+        # The database is thrown away afterwards, so skip the journal file and fsyncs
+        cursor.execute("PRAGMA journal_mode=MEMORY")
+        cursor.execute("PRAGMA synchronous=OFF")
+    else:
+        # WAL lets readers proceed during writes, and NORMAL sync avoids an fsync per commit
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
 Base = declarative_base()
 
+# The current UTC time in the format SQLAlchemy stores DateTime values in on SQLite.
+# CURRENT_TIMESTAMP omits the microseconds, which breaks text comparisons against
+# timestamps bound from Python.
+UTC_NOW = text("(strftime('%Y-%m-%d %H:%M:%f000', 'now'))")
+
+# Property ids recently confirmed to exist, mapped to when that confirmation expires
+known_properties: dict[int, float] = {}
+
 
 ### Define SQLAlchemy models ###
 class Property(Base):
@@ -34,12 +103,65 @@ class Property(Base):
 
 class Log(Base):
     __tablename__ = "logs"
-    propertyId = Column(Integer, ForeignKey("properties.id"), nullable=False)
+    __table_args__ = (
+        Index("ix_logs_prop_evt", "propertyId", "id"),
+        Index("ix_logs_prop_ts", "propertyId", "timestamp"),
+    )
+    propertyId = Column(
+        Integer, ForeignKey("properties.id", ondelete="CASCADE"), nullable=False
+    )
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    timestamp = Column(DateTime, default=func.now())
+    # The client-side default is the same SQL expression, so SQLite fills in the
+    # time either way; it also covers tables created before the server default existed
+    timestamp = Column(
+        DateTime,
+        default=UTC_NOW,
+        server_default=UTC_NOW,
+        nullable=False,
+    )
     description = Column(Text)
 
 
+# Columns returned by the API, for queries that don't need full ORM objects
+PROPERTY_COLUMNS = (Property.id, Property.number, Property.notes)
+LOG_COLUMNS = (Log.id, Log.propertyId, Log.timestamp, Log.description)
+
+
+### Define Pydantic models ###
+class EventIn(BaseModel):
+    description: str
+    timestamp: str | None = None
+
+
+class PropertyOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    number: str
+    notes: str | None
+
+
+class PropertyPage(BaseModel):
+    items: list[PropertyOut]
+    next_cursor: int | None
+
+
+class LogOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    propertyId: int
+    timestamp: datetime | None
+    description: str | None
+
+
+class LogPage(BaseModel):
+    items: list[LogOut]
+    next_cursor: int | None
+
+
+class Message(BaseModel):
+    message: str
+
+
 ### Set up FastAPI ###
 tags_metadata = [
     {
@@ -52,134 +174,174 @@ tags_metadata = [
     },
 ]
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create the database if it doesn't exist
+    await init_db(Base, engine)
+    yield
+    await engine.dispose()
+    if TESTING:
+        os.remove(test_database_path)
+
+
 app = FastAPI(
     title="Property Event Logging",
     description="A simple database API server for logging events relating to properties.",
     version="1",
     openapi_tags=tags_metadata,
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 
 ### Helper methods ###
-def init_db(base, engine):
-    base.metadata.create_all(bind=engine)
+async def init_db(base, engine):
+    # IF NOT EXISTS keeps this safe when several workers start at once, and adds
+    # any missing indexes to tables that already exist
+    async with engine.begin() as conn:
+        for table in base.metadata.sorted_tables:
+            await conn.execute(CreateTable(table, if_not_exists=True))
+            for index in table.indexes:
+                await conn.execute(CreateIndex(index, if_not_exists=True))
     print("Initialized database.")
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionMaker() as db:
         yield db
-    finally:
-        db.close()
 
 
+@lru_cache(maxsize=1024)
 def validateDateTime(
     dateTimeString: str, defaultTime: time = time.min
 ) -> datetime | None:
     try:
-        parsedDateTime = datetime.fromisoformat(dateTimeString)
-        if parsedDateTime:
-            parsedTime = parsedDateTime.time()
-            return (
-                datetime.combine(parsedDateTime, defaultTime)
-                if parsedTime == time.min
-                else parsedDateTime
-            )
-        return None
+        # Date-only strings (e.g. YYYY-MM-DD) are never longer than 10 characters
+        if len(dateTimeString) <= 10:
+            return datetime.combine(date.fromisoformat(dateTimeString), defaultTime)
+        return datetime.fromisoformat(dateTimeString)
     except ValueError:
         return None
 
 
-# Create the database if it doesn't exist
-init_db(Base, engine)
+def split_page(rows, limit: int):
+    """Split a query fetched with limit + 1 rows into the page and the next cursor."""
+    items = rows[:limit]
+    next_cursor = items[-1].id if len(rows) > limit else None
+    return items, next_cursor
+
+
+async def property_exists(db: AsyncSession, property_id: int) -> bool:
+    """Check whether a property exists, remembering ids that do for a short time."""
+    expires = known_properties.get(property_id)
+    if expires is not None and expires > monotonic():
+        return True
+
+    result = await db.execute(
+        lambda_stmt(lambda: select(Property.id).where(Property.id == property_id))
+    )
+    if result.scalar_one_or_none() is None:
+        known_properties.pop(property_id, None)
+        return False
+
+    if len(known_properties) >= PROPERTY_CACHE_SIZE:
+        known_properties.clear()
+    known_properties[property_id] = monotonic() + PROPERTY_CACHE_TTL
+    return True
 
 
 ### Property endpoints ###
-@app.post("/properties/", tags=["properties"])
-def create_property(number: str, notes: str, db: Session = Depends(get_db)):
+@app.post("/properties/", tags=["properties"], response_model=PropertyOut)
+async def create_property(number: str, notes: str, db: AsyncSession = Depends(get_db)):
     """Create a property in the database."""
-    property_ = Property(number=number, notes=notes)
-    db.add(property_)
-    db.commit()
-    db.refresh(property_)
+    result = await db.execute(
+        insert(Property).values(number=number, notes=notes).returning(*PROPERTY_COLUMNS)
+    )
+    property_ = result.one()
+    await db.commit()
     return property_
 
 
-@app.get("/properties/", tags=["properties"])
-def get_all_properties(db: Session = Depends(get_db)):
-    """Get a list of all properties in the database."""
-    properties = db.query(Property.id, Property.number, Property.notes).all()
-    return [
-        Property(
-            id=p.id,
-            number=p.number,
-            notes=p.notes,
-        )
-        for p in properties
-    ]
+@app.get("/properties/", tags=["properties"], response_model=PropertyPage)
+async def get_all_properties(
+    after_id: int | None = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    """Get a page of properties in the database. Pass next_cursor as after_id to get the next page."""
+    query = select(*PROPERTY_COLUMNS)
+    if after_id is not None:
+        query = query.where(Property.id > after_id)
+    result = await db.execute(query.order_by(Property.id).limit(limit + 1))
+    properties, next_cursor = split_page(result.all(), limit)
+    return {"items": properties, "next_cursor": next_cursor}
 
 
-@app.get("/properties/{property_id}", tags=["properties"])
-def get_property(property_id: int, db: Session = Depends(get_db)):
+@app.get("/properties/{property_id}", tags=["properties"], response_model=PropertyOut)
+async def get_property(property_id: int, db: AsyncSession = Depends(get_db)):
     """Get a property from the database, including notes."""
-    property_ = db.query(Property).filter(Property.id == property_id).first()
+    result = await db.execute(
+        lambda_stmt(lambda: select(*PROPERTY_COLUMNS).where(Property.id == property_id))
+    )
+    property_ = result.one_or_none()
     if property_ is None:
         raise HTTPException(status_code=404, detail="Property not found.")
     return property_
 
 
-@app.put("/properties/{property_id}", tags=["properties"])
-def update_property(
-    property_id: int, number: str, notes: str, db: Session = Depends(get_db)
+@app.put("/properties/{property_id}", tags=["properties"], response_model=PropertyOut)
+async def update_property(
+    property_id: int, number: str, notes: str, db: AsyncSession = Depends(get_db)
 ):
     """Update a property's base information in the database."""
-    property_ = db.query(Property).filter(Property.id == property_id).first()
+    result = await db.execute(select(Property).where(Property.id == property_id))
+    property_ = result.scalar_one_or_none()
     if property_ is None:
         raise HTTPException(status_code=404, detail="Property not found.")
     property_.number = number
     property_.notes = notes
-    db.commit()
+    await db.commit()
     return property_
 
 
 # Note that we should typically not permanently delete data.
 # Instead, we should simply set a flag on the property to hide it from results.
 # For simplicity's sake, for now I'm going to delete it, though.
-@app.delete("/properties/{property_id}", tags=["properties"])
-def delete_property(property_id: int, db: Session = Depends(get_db)):
+@app.delete("/properties/{property_id}", tags=["properties"], response_model=Message)
+async def delete_property(property_id: int, db: AsyncSession = Depends(get_db)):
     """Permanently delete a property in the database, along with all associated events."""
-    # Retrieve the property
-    property_ = db.query(Property).filter(Property.id == property_id).first()
-    if property_ is None:
-        raise HTTPException(status_code=404, detail="Property not found.")
+    known_properties.pop(property_id, None)
 
-    # Delete all logs associated with the property
-    logs = db.query(Log).filter(Log.propertyId == property_id).all()
-    for log in logs:
-        db.delete(log)
+    # Delete all logs associated with the property.
+    # New databases cascade this, but ones created before ondelete="CASCADE" don't.
+    await db.execute(delete(Log).where(Log.propertyId == property_id))
 
     # Delete the property itself
-    db.delete(property_)
-    db.commit()
+    result = await db.execute(delete(Property).where(Property.id == property_id))
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Property not found.")
+    await db.commit()
     return {"message": "Property and associated logs deleted."}
 
 
 ### Event endpoints ###
-@app.get("/properties/{property_id}/events", tags=["events"])
-def get_property_events(
+@app.get("/properties/{property_id}/events", tags=["events"], response_model=LogPage)
+async def get_property_events(
     property_id: int,
     start_date: str | None = None,
     end_date: str | None = None,
-    db: Session = Depends(get_db),
+    after_id: int | None = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
 ):
-    """Get all the events associated with a property. Optionally filter by date/time range."""
-    query = db.query(Log).filter(Log.propertyId == property_id)
+    """Get a page of the events associated with a property. Optionally filter by date/time range."""
+    conditions = [Log.propertyId == property_id]
 
     if start_date:
         parsed_start = validateDateTime(start_date, time.min)
         if parsed_start:
-            query = query.filter(Log.timestamp >= parsed_start)
+            conditions.append(Log.timestamp >= parsed_start)
         else:
             raise HTTPException(
                 status_code=400,
@@ -189,40 +351,38 @@ def get_property_events(
     if end_date:
         parsed_end = validateDateTime(end_date, time.max)
         if parsed_end:
-            query = query.filter(Log.timestamp >= parsed_end)
+            conditions.append(Log.timestamp <= parsed_end)
         else:
             raise HTTPException(
                 status_code=400,
                 detail="Unable to parse end_date. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS",
             )
 
-    logs = query.all()
-    if not logs:
+    if after_id is not None:
+        conditions.append(Log.id > after_id)
+
+    query = select(*LOG_COLUMNS).where(*conditions).order_by(Log.id).limit(limit + 1)
+    result = await db.execute(query)
+    logs, next_cursor = split_page(result.all(), limit)
+    if not logs and after_id is None:
         if start_date or end_date:
             error_detail = "No events found for this property in the given range."
         else:
             error_detail = "No events found for this property."
         raise HTTPException(status_code=404, detail=error_detail)
 
-    return [
-        Log(
-            id=log.id,
-            propertyId=log.propertyId,
-            timestamp=log.timestamp,
-            description=log.description,
-        )
-        for log in logs
-    ]
+    return {"items": logs, "next_cursor": next_cursor}
 
 
-@app.post("/properties/{property_id}/events/", tags=["events"])
-def create_event(
+@app.post("/properties/{property_id}/events/", tags=["events"], response_model=LogOut)
+async def create_event(
     property_id: int,
     description: str,
     timestamp: str | None = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Log a new event for the given property."""
+    values = {"propertyId": property_id, "description": description}
     if timestamp:
         parsed_timestamp = validateDateTime(timestamp, time.min)
         if not parsed_timestamp:
@@ -230,26 +390,83 @@ def create_event(
                 status_code=400,
                 detail="Unable to parse timestamp. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS",
             )
-    else:
-        parsed_timestamp = datetime.now()
+        values["timestamp"] = parsed_timestamp
 
-    log = Log(
-        propertyId=property_id, timestamp=parsed_timestamp, description=description
-    )
-    db.add(log)
-    db.commit()
-    db.refresh(log)
+    if not await property_exists(db, property_id):
+        raise HTTPException(status_code=404, detail="Property not found.")
+
+    # The cache may be stale if another worker deleted the property
+    try:
+        result = await db.execute(insert(Log).values(**values).returning(*LOG_COLUMNS))
+        log = result.one()
+        await db.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="Property not found.")
     return log
 
 
-@app.get("/properties/{property_id}/events/{event_id}", tags=["events"])
-def get_event(property_id: int, event_id: int, db: Session = Depends(get_db)):
+@app.post(
+    "/properties/{property_id}/events/bulk", tags=["events"], response_model=Message
+)
+async def create_events(
+    property_id: int,
+    events: list[EventIn] = Body(..., max_length=MAX_BULK_EVENTS),
+    db: AsyncSession = Depends(get_db),
+):
+    """Log several new events for the given property in a single transaction."""
+    if not await property_exists(db, property_id):
+        raise HTTPException(status_code=404, detail="Property not found.")
+
+    # Filling in one time for the whole request keeps the same keys in every row,
+    # so the batch goes out as a single executemany. It's truncated to milliseconds
+    # to match the precision of UTC_NOW.
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    rows = []
+    for event_ in events:
+        if event_.timestamp:
+            parsed_timestamp = validateDateTime(event_.timestamp, time.min)
+            if not parsed_timestamp:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Unable to parse timestamp '{event_.timestamp}'. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS",
+                )
+        else:
+            parsed_timestamp = now
+        rows.append(
+            {
+                "propertyId": property_id,
+                "timestamp": parsed_timestamp,
+                "description": event_.description,
+            }
+        )
+
+    if rows:
+        try:
+            await db.execute(insert(Log), rows)
+            await db.commit()
+        except IntegrityError:
+            raise HTTPException(status_code=404, detail="Property not found.")
+    return {"message": f"{len(rows)} events logged."}
+
+
+@app.get(
+    "/properties/{property_id}/events/{event_id}",
+    tags=["events"],
+    response_model=LogOut,
+)
+async def get_event(
+    property_id: int, event_id: int, db: AsyncSession = Depends(get_db)
+):
     """Get an event for the given property."""
-    log = (
-        db.query(Log)
-        .filter(Log.propertyId == property_id and Log.id == event_id)
-        .first()
+    result = await db.execute(
+        lambda_stmt(
+            lambda: select(*LOG_COLUMNS).where(
+                Log.propertyId == property_id, Log.id == event_id
+            )
+        )
     )
+    log = result.one_or_none()
     if log is None:
         raise HTTPException(status_code=404, detail="Log not found.")
     return log
@@ -258,23 +475,35 @@ def get_event(property_id: int, event_id: int, db: Session = Depends(get_db)):
 # Note that we should typically not permanently delete data.
 # Instead, we should simply set a flag on the property to hide it from results.
 # For simplicity's sake, for now I'm going to delete it, though.
-@app.delete("/properties/{property_id}/events/{event_id}", tags=["events"])
-def delete_event(property_id: int, event_id: int, db: Session = Depends(get_db)):
+@app.delete(
+    "/properties/{property_id}/events/{event_id}",
+    tags=["events"],
+    response_model=Message,
+)
+async def delete_event(
+    property_id: int, event_id: int, db: AsyncSession = Depends(get_db)
+):
     """Permanently delete an event from the database."""
-    log = (
-        db.query(Log)
-        .filter(Log.propertyId == property_id and Log.id == event_id)
-        .first()
+    result = await db.execute(
+        delete(Log).where(Log.propertyId == property_id, Log.id == event_id)
     )
-    if log is None:
+    if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Event not found")
-    db.delete(log)
-    db.commit()
+    await db.commit()
     return {"message": "Event deleted"}
 
 
 if __name__ == "__main__":
 
-    host = int(os.getenv("HOST", "0.0.0.0"))
+    host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 8100))
-    uvicorn.run("server:app", host=host, port=port, reload=True)
+    workers = int(os.getenv("WORKERS", 2))
+    uvicorn.run(
+        "server:app",
+        host=host,
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        reload=False,
+    )
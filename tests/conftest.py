@@ -0,0 +1,4 @@
+import os
+
+# Must be set before the server module is imported, since it picks the engine then
+os.environ["TESTING"] = "1"
@@ -0,0 +1,44 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from server import server
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(server.app) as client:
+        yield client
+
+
+@pytest.fixture
+def property_id(client):
+    response = client.post("/properties/", params={"number": "1A", "notes": ""})
+    return response.json()["id"]
+
+
+def test_start_date_matches_default_timestamp(client, property_id):
+    event_ = client.post(
+        f"/properties/{property_id}/events/", params={"description": "default"}
+    ).json()
+
+    for start_date in (event_["timestamp"], event_["timestamp"][:19]):
+        response = client.get(
+            f"/properties/{property_id}/events", params={"start_date": start_date}
+        )
+        assert response.status_code == 200
+        assert [e["id"] for e in response.json()["items"]] == [event_["id"]]
+
+
+def test_bulk_insert_keeps_request_order(client, property_id):
+    events = [
+        {"description": "first"},
+        {"description": "second", "timestamp": "2024-01-01T12:00:00"},
+        {"description": "third"},
+    ]
+    response = client.post(f"/properties/{property_id}/events/bulk", json=events)
+    assert response.status_code == 200
+
+    items = client.get(f"/properties/{property_id}/events").json()["items"]
+    assert [e["description"] for e in items] == ["first", "second", "third"]
+    assert items[1]["timestamp"] == "2024-01-01T12:00:00"
+    assert items[0]["timestamp"] == items[2]["timestamp"]